@@ -0,0 +1,42 @@
+/**
+* SUMMARY JOB CHECKPOINTS
+* Note: jobs record their completed stages in checkpoints and claim a job in claims, so that a retried job resumes from the last completed stage.
+*/
+alter table summaries add column checkpoints jsonb not null default '{}'::jsonb;
+alter table summaries add column claims jsonb not null default '{}'::jsonb;
+
+/**
+* Merge a single stage into checkpoints, so that concurrent jobs never overwrite each other's stages.
+*/
+create or replace function save_checkpoint(summary_id bigint, stage text, value jsonb)
+returns void as $$
+  update summaries
+  set checkpoints = coalesce(checkpoints, '{}'::jsonb) || jsonb_build_object(stage, value)
+  where id = summary_id;
+$$ language sql;
+
+/**
+* Claim or renew a job for a worker. Fails if another worker holds a claim that is younger than lease_seconds.
+*/
+create or replace function claim_job(summary_id bigint, job text, worker text, lease_seconds integer)
+returns boolean as $$
+begin
+  update summaries
+  set claims = coalesce(claims, '{}'::jsonb) || jsonb_build_object(job, jsonb_build_object('worker', worker, 'claimed_at', extract(epoch from now())))
+  where id = summary_id
+    and (claims -> job is null
+      or claims -> job ->> 'worker' = worker
+      or (claims -> job ->> 'claimed_at')::double precision < extract(epoch from now()) - lease_seconds);
+  return found;
+end;
+$$ language plpgsql;
+
+/**
+* Release a job claimed by the worker.
+*/
+create or replace function release_job(summary_id bigint, job text, worker text)
+returns void as $$
+  update summaries
+  set claims = claims - job
+  where id = summary_id and claims -> job ->> 'worker' = worker;
+$$ language sql;
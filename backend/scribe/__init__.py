@@ -1,5 +1,6 @@
 """Scribe package initializer."""
 import os
+import threading
 from flask import Flask
 from flask_cors import CORS
 from dotenv import load_dotenv
@@ -35,10 +36,16 @@ def create_app(test_config=None):
 
         from . import api
         from . import auth
+        from . import summary
 
         app.register_blueprint(api.bp)
         app.register_error_handler(auth.AuthError, auth.handle_auth_error)
 
+        # Restart summary jobs whose worker died, on startup and then periodically
+        if not app.testing:
+            threading.Thread(target=summary.resume_jobs_forever,
+                             daemon=True).start()
+
     CORS(app)
     return app
 
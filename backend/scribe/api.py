@@ -79,11 +79,17 @@ def submit():
             jobName=f'transcribe_{summary_id}',
             jobQueue="scribe-job-queue",
             jobDefinition="scribe-job-definition",
+            # Failed jobs resume from the last checkpoint
+            retryStrategy={'attempts': app.config['BATCH_ATTEMPTS']},
             containerOverrides={
                 'command': [
                     'python3',
                     'transcribe.py',
                     summary_id,
+                ],
+                'environment': [
+                    {'name': 'BATCH_ATTEMPTS',
+                        'value': str(app.config['BATCH_ATTEMPTS'])},
                 ]
             }
         )
@@ -101,6 +107,8 @@ def submit():
         summary_id = data[1][0]['id']
         approval_link = url_for(
             'api.approve', summary_id=summary_id, _external=True)
+        # Record the job so that it is resumed if this process dies
+        summary.save_checkpoint(summary_id, {}, 'approval_link', approval_link)
         # Run generate_summary asynchronously
         thread = threading.Thread(target=summary.generate_summary,
                                   args=(summary_id, filename, approval_link))
@@ -130,6 +138,8 @@ def summarize():
 
     approval_link = url_for(
         'api.approve', summary_id=summary_id, _external=True)
+    # Record the job so that it is resumed if this process dies
+    summary.save_checkpoint(summary_id, {}, 'approval_link', approval_link)
     # Run generate_summary asynchronously
     thread = threading.Thread(target=summary.generate_summary,
                               args=(summary_id, download_path, approval_link))
@@ -156,6 +166,8 @@ def approve(summary_id):
     s3.download_file(Bucket=app.config["S3_BUCKET"],
                      Key=res['transcript_file'], Filename=transcript_path)
 
+    # Record the approval so that the summary is sent even if this process dies
+    summary.save_checkpoint(res['id'], {}, 'summary_approved')
     thread = threading.Thread(target=summary.send_summary,
                               args=(res['id'], res['user_email'], summary_path, transcript_path))
     thread.start()
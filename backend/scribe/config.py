@@ -10,3 +10,4 @@ AUDIO_EXTENSIONS = {'.mp3', '.mp4', '.m4a',
 TEXT_EXTENSIONS = {'.txt'}
 S3_BUCKET = "scribe-backend-files"
 MAX_CONTENT_LENGTH = 300 * 1000 * 1000  # 300 MB
+BATCH_ATTEMPTS = 3
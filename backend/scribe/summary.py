@@ -3,6 +3,10 @@ import smtplib
 import ssl
 import os
 import time
+import json
+import uuid
+import hashlib
+import threading
 import traceback
 from functools import wraps
 from datetime import datetime
@@ -14,41 +18,175 @@ import openai
 import boto3
 import tiktoken
 from supabase import Client
-from tenacity import retry, stop_after_attempt, wait_fixed
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_fixed
 from flask import current_app as app
 
 # The reason we declare this on the top level is that we only have access to the app context during intialization
 supabase: Client = app.extensions['supabase']
 S3_BUCKET = app.config['S3_BUCKET']
 SUMMARIES_FOLDER = app.config['SUMMARIES_FOLDER']
+TRANSCRIPTS_FOLDER = app.config['TRANSCRIPTS_FOLDER']
+
+# Models with their context lengths and the most tokens they output, from the smallest context window to the largest
+MODELS = [("gpt-3.5-turbo", 4096, 4096), ("gpt-3.5-turbo-16k", 16384, 4096)]
+# Chat format overhead from the tiktoken cookbook: tokens added per message and to prime the reply
+MESSAGE_TOKENS = 4
+REPLY_TOKENS = 3
+# Margin for how different model snapshots format the messages
+SAFETY_TOKENS = 50
+# Output budget to route on, longer than the summaries we expect so that they are rarely cut off
+SUMMARY_TOKENS = 2048
+MAX_CONTINUATIONS = 2
+CONTINUE_PROMPT = "Continue exactly where you left off."
+# Attempts of a job before the error is final and seconds to wait between them
+MAX_ATTEMPTS = 3
+RETRY_WAIT = 60
+# Errors worth retrying, any other error fails the same way every time
+TRANSIENT_ERRORS = (openai.error.RateLimitError, openai.error.APIError, openai.error.ServiceUnavailableError,
+                    openai.error.Timeout, openai.error.APIConnectionError, smtplib.SMTPServerDisconnected,
+                    ConnectionError, TimeoutError)
+# Seconds after which the claim of a job can be taken over, the worker renews it while the job runs
+CLAIM_LEASE = 5 * 60
+# Seconds between looking for jobs whose worker died
+RESUME_INTERVAL = 5 * 60
 
 
 def handle_exceptions(func):
-    """Catch any exceptions and put the traceback into the database."""
+    """Claim the job, retry transient errors from the last checkpoint and put the final traceback into the database."""
     @wraps(func)
     def decorated(*args, **kwargs):
+        summary_id = args[0]
+        worker = uuid.uuid4().hex
+        if not claim_job(summary_id, func.__name__, worker):
+            print(
+                f"{func.__name__} is already running for summary_id: {summary_id}", flush=True)
+            return None
+        # The claim expires if the process dies, so that resume_jobs can restart the job
+        done = threading.Event()
+        threading.Thread(target=renew_claim, args=(
+            summary_id, func.__name__, worker, done), daemon=True).start()
         try:
-            return func(*args, **kwargs)
-        except Exception:
-            trace = traceback.format_exc()
-            print(trace, flush=True)
-            summary_id = args[0]
-            supabase.table('summaries').update(
-                {'status': f'Error: {trace}'}).eq('id', summary_id).execute()
+            for attempt in range(1, MAX_ATTEMPTS + 1):
+                try:
+                    return func(*args, **kwargs)
+                except Exception as error:
+                    trace = traceback.format_exc()
+                    print(trace, flush=True)
+                    if attempt == MAX_ATTEMPTS or not isinstance(error, TRANSIENT_ERRORS):
+                        supabase.table('summaries').update(
+                            {'status': f'Error: {trace}'}).eq('id', summary_id).execute()
+                        return None
+                    supabase.table('summaries').update(
+                        {'status': f'Retrying: {trace}'}).eq('id', summary_id).execute()
+                    time.sleep(RETRY_WAIT)
+                    # Clear the error of the previous attempt
+                    supabase.table('summaries').update(
+                        {'status': None}).eq('id', summary_id).execute()
+        finally:
+            done.set()
+            release_job(summary_id, func.__name__, worker)
     return decorated
 
 
+def claim_job(summary_id: str, job: str, worker: str) -> bool:
+    """Claim the job so that duplicate requests don't run it at the same time."""
+    return supabase.rpc('claim_job', {'summary_id': summary_id, 'job': job,
+                                      'worker': worker, 'lease_seconds': CLAIM_LEASE}).execute().data
+
+
+def renew_claim(summary_id: str, job: str, worker: str, done: threading.Event):
+    """Renew the claim on the job until it is done."""
+    while not done.wait(CLAIM_LEASE / 3):
+        claim_job(summary_id, job, worker)
+
+
+def release_job(summary_id: str, job: str, worker: str):
+    """Release the claim on the job."""
+    supabase.rpc('release_job', {'summary_id': summary_id,
+                 'job': job, 'worker': worker}).execute()
+
+
+def get_checkpoints(summary_id: str) -> dict:
+    """Fetch the completed stages of the job from the database."""
+    return supabase.table('summaries').select('checkpoints').eq(
+        'id', summary_id).execute().data[0]['checkpoints'] or {}
+
+
+def save_checkpoint(summary_id: str, checkpoints: dict, stage: str, value=True):
+    """Merge a completed stage of the job into the database."""
+    checkpoints[stage] = value
+    supabase.rpc('save_checkpoint', {'summary_id': summary_id,
+                 'stage': stage, 'value': value}).execute()
+
+
+def resume_jobs() -> list:
+    """Restart the summary jobs whose worker died before finishing them and return their threads."""
+    rows = supabase.table('summaries').select('id', 'user_email', 'transcript_file', 'summary_file', 'status', 'checkpoints', 'claims').is_(
+        'sent_at', 'null').execute().data
+    s3 = boto3.client('s3')
+    threads = []
+    for row in rows:
+        checkpoints = row['checkpoints'] or {}
+        # Jobs with a final error fail the same way until they are fixed and restarted by hand
+        if row['status'] is not None and row['status'].startswith('Error'):
+            continue
+        if 'approval_link' in checkpoints and not checkpoints.get('approval_email_sent'):
+            job = generate_summary
+        elif checkpoints.get('summary_approved'):
+            job = send_summary
+        else:
+            continue
+        claim = (row['claims'] or {}).get(job.__name__)
+        if claim is not None and claim['claimed_at'] > time.time() - CLAIM_LEASE:
+            continue
+
+        print(
+            f"Resuming {job.__name__} for summary_id: {row['id']}", flush=True)
+        transcript_path = os.path.join(
+            TRANSCRIPTS_FOLDER, row['transcript_file'].split('/')[-1])
+        s3.download_file(Bucket=S3_BUCKET,
+                         Key=row['transcript_file'], Filename=transcript_path)
+        if job is generate_summary:
+            args = (row['id'], transcript_path, checkpoints['approval_link'])
+        else:
+            summary_path = os.path.join(
+                SUMMARIES_FOLDER, row['summary_file'].split('/')[-1])
+            s3.download_file(Bucket=S3_BUCKET,
+                             Key=row['summary_file'], Filename=summary_path)
+            args = (row['id'], row['user_email'],
+                    summary_path, transcript_path)
+        thread = threading.Thread(target=job, args=args)
+        thread.start()
+        threads.append(thread)
+    return threads
+
+
+def resume_jobs_forever():
+    """Look for jobs whose worker died every RESUME_INTERVAL seconds."""
+    while True:
+        try:
+            resume_jobs()
+        except Exception:
+            print(traceback.format_exc(), flush=True)
+        time.sleep(RESUME_INTERVAL)
+
+
 @handle_exceptions
 def send_summary(summary_id: str, user_email: str, summary_filename: str, transcript_filename: str):
     """Send summary to user."""
     print(f"Sending summary for summary_id: {summary_id}", flush=True)
     text = "Hey there, \n\nPlease find the notes from your recent conversation attached. We also included the transcript in case you want to refresh your memory.\n\nThank you for using Scribe!\n\nSincerely,\nThe Scribe Team\n\nP.S. While a powerful tool, Scribe is an early-stage project, and we live for your feedback. Please take 2 minutes to let us know what worked and what didn't, so we can make Scribe better for you. Or tweet your feedback @tryscribeai."
     subject = "Scribe Summary"
-    send_mail(user_email, subject, text, [
-              summary_filename, transcript_filename])
-    update_time(summary_id)
+    checkpoints = get_checkpoints(summary_id)
+    # Check if the summary was already sent to the user
+    if not checkpoints.get('summary_email_sent'):
+        send_mail(user_email, subject, text, [
+                  summary_filename, transcript_filename])
+        save_checkpoint(summary_id, checkpoints, 'summary_email_sent')
     supabase.table('summaries').update(
         {'status': "Success"}).eq('id', summary_id).execute()
+    # Jobs without sent_at are resumed, so it is updated last
+    update_time(summary_id)
     os.remove(transcript_filename)
     os.remove(summary_filename)
 
@@ -58,6 +196,20 @@ def generate_summary(summary_id: int, transcript_filename: str, approval_link: s
     """Generate a summary given a transcript."""
     print(f"Generating summary for summary_id: {summary_id}", flush=True)
     start_time = time.time()
+    usage = {'status': 'error', 'calls': 0, 'prompt_tokens': 0,
+             'completion_tokens': 0, 'models': []}
+    # Log the usage of every job, including failed and resumed ones
+    try:
+        run_summary(summary_id, transcript_filename, approval_link, usage)
+    finally:
+        usage['latency'] = round(time.time() - start_time, 3)
+        print(
+            f"Usage for summary_id {summary_id}: {json.dumps(usage)}", flush=True)
+        print(f"Time taken: {usage['latency']}", flush=True)
+
+
+def run_summary(summary_id: int, transcript_filename: str, approval_link: str, usage: dict):
+    """Summarize the transcript, upload the summary and send it for approval."""
     # Set API key, prompt, and model
     openai.api_key = os.getenv("OPENAI_API_KEY")
     prompt_summary = os.getenv("PROMPT_SUMMARY")
@@ -66,95 +218,156 @@ def generate_summary(summary_id: int, transcript_filename: str, approval_link: s
     if prompt_summary is None or prompt_chunk_summary is None or prompt_final_summary is None:
         raise Exception("Prompts not set")
 
-    model = "gpt-3.5-turbo-16k"
-    enc = tiktoken.encoding_for_model(model)
-    context_length = 16384
-    system_messages = 20
-
-    # Prompt length and 20 tokens for the system messages
-    summary_prompt_length = len(enc.encode(
-        prompt_summary)) + system_messages
-    chunk_prompt_length = len(enc.encode(
-        prompt_chunk_summary)) + system_messages
-    final_prompt_length = len(enc.encode(
-        prompt_final_summary)) + system_messages
-    prompt_length = max(chunk_prompt_length,
-                        final_prompt_length, summary_prompt_length)
-    # Give at least 1000 tokens for the summary
-    max_tokens = context_length - prompt_length - 1000
-    summary = ""
+    enc = tiktoken.encoding_for_model(MODELS[0][0])
 
-    with open(transcript_filename, "r", encoding="UTF-8") as file:
-        transcript = file.read()
-
-    if transcript == "":
-        raise Exception("Transcript is empty")
-
-    num_tokens = len(enc.encode(transcript))
-
-    # Check if the transcript can be summarized in one chunk
-    if num_tokens <= max_tokens:
-        # Send the transcript to the OpenAI API
-        summary = get_summary(model, prompt_summary,
-                              transcript)
-
-    if num_tokens > max_tokens:
-        # Split the transcript into chunks recursively
-        transcript_chunks = []
-        split_transcript(transcript, max_tokens, transcript_chunks, enc)
-        summary_chunks = []
-        # Summarize each chunk
-        for chunk in transcript_chunks:
-            summary_chunk = get_summary(model, prompt_chunk_summary, chunk)
-            summary_chunks.append(summary_chunk)
-        # Create master summary
-        summary_chunks = '\n'.join(summary_chunks) + "\nMaster summary: "
-        print(prompt_final_summary, flush=True)
-        print(summary_chunks, flush=True)
-        summary = get_summary(model, prompt_final_summary, summary_chunks)
-
-    if summary == "":
-        raise Exception("Summary is empty")
-
-    # Save the summary to a file
-    user_email = supabase.table('summaries').select("user_email").eq(
-        'id', summary_id).execute().data[0]['user_email']
-    summary_filename = save_summary(
-        summary, SUMMARIES_FOLDER, user_email)
-
-    # Upload the summary to S3
-    s3 = boto3.client('s3')
-    s3_filename = summary_filename.rsplit(
-        '/', 2)[1] + '/' + summary_filename.rsplit('/', 2)[2]
-    s3.upload_file(summary_filename, S3_BUCKET, s3_filename)
+    res = supabase.table('summaries').select('user_email', 'summary_file', 'checkpoints').eq(
+        'id', summary_id).execute().data[0]
+    checkpoints = res['checkpoints'] or {}
 
-    # Save the summary in the database
-    supabase.table('summaries').update(
-        {'summary_file': s3_filename}).eq('id', summary_id).execute()
+    # Check if a previous attempt already finished the job
+    if checkpoints.get('approval_email_sent'):
+        usage['status'] = 'skipped'
+        if os.path.exists(transcript_filename):
+            os.remove(transcript_filename)
+        return
+
+    s3 = boto3.client('s3')
+    # Skip the summarization if a previous attempt already uploaded the summary
+    if res['summary_file'] is not None:
+        usage['resumed_from'] = 'summary_file'
+        summary_filename = os.path.join(
+            SUMMARIES_FOLDER, res['summary_file'].split('/')[-1])
+        s3.download_file(Bucket=S3_BUCKET,
+                         Key=res['summary_file'], Filename=summary_filename)
+    else:
+        with open(transcript_filename, "r", encoding="UTF-8") as file:
+            transcript = file.read()
+
+        if transcript == "":
+            raise Exception("Transcript is empty")
+
+        # Check if the transcript can be summarized in one chunk
+        messages = build_messages(prompt_summary, transcript)
+        if route_model(count_tokens(messages, enc)) is not None:
+            summary = get_summary(prompt_summary, transcript, enc, usage)
+        else:
+            # Leave room for the largest prompt and the summary in the biggest context window
+            prompt_length = max(count_tokens(build_messages(prompt, ""), enc) for prompt in (
+                prompt_chunk_summary, prompt_final_summary))
+            max_tokens = MODELS[-1][1] - prompt_length - SUMMARY_TOKENS
+            # Split the transcript into chunks recursively
+            transcript_chunks = []
+            split_transcript(transcript, max_tokens, transcript_chunks, enc)
+            # Reuse the chunk summaries from previous attempts if the transcript was split the same way
+            chunks_hash = hashlib.sha256(json.dumps(
+                transcript_chunks).encode('utf-8')).hexdigest()
+            saved_chunks = checkpoints.get('chunk_summaries') or {}
+            summary_chunks = saved_chunks['summaries'] if saved_chunks.get(
+                'chunks_hash') == chunks_hash else []
+            if summary_chunks:
+                usage['resumed_from'] = f'chunk {len(summary_chunks)}'
+            # Summarize each chunk
+            for chunk in transcript_chunks[len(summary_chunks):]:
+                summary_chunk = get_summary(
+                    prompt_chunk_summary, chunk, enc, usage)
+                summary_chunks.append(summary_chunk)
+                save_checkpoint(summary_id, checkpoints, 'chunk_summaries', {
+                                'chunks_hash': chunks_hash, 'summaries': summary_chunks})
+            # Create master summary
+            summary_chunks = '\n'.join(summary_chunks) + "\nMaster summary: "
+            print(prompt_final_summary, flush=True)
+            print(summary_chunks, flush=True)
+            summary = get_summary(prompt_final_summary,
+                                  summary_chunks, enc, usage)
+
+        if summary == "":
+            raise Exception("Summary is empty")
+
+        # Save the summary to a file
+        summary_filename = save_summary(
+            summary, SUMMARIES_FOLDER, res['user_email'])
+
+        # Upload the summary to S3
+        s3_filename = summary_filename.rsplit(
+            '/', 2)[1] + '/' + summary_filename.rsplit('/', 2)[2]
+        s3.upload_file(summary_filename, S3_BUCKET, s3_filename)
+
+        # Save the summary in the database
+        supabase.table('summaries').update(
+            {'summary_file': s3_filename}).eq('id', summary_id).execute()
 
     # Send the approval email
     send_approval_email(summary_filename, transcript_filename, approval_link)
+    save_checkpoint(summary_id, checkpoints, 'approval_email_sent')
 
     os.remove(transcript_filename)
     os.remove(summary_filename)
+    usage['status'] = 'success'
+
 
-    print(f"Time taken: {time.time() - start_time}", flush=True)
+def build_messages(prompt: str, text: str) -> list:
+    """Build the chat messages for a summary request."""
+    return [{"role": "system", "content": prompt},
+            {"role": "user", "content": text}]
+
+
+def count_tokens(messages: list, enc) -> int:
+    """Estimate an upper bound of the prompt tokens the chat format uses for messages."""
+    num_tokens = REPLY_TOKENS + SAFETY_TOKENS
+    for message in messages:
+        num_tokens += MESSAGE_TOKENS
+        for value in message.values():
+            num_tokens += len(enc.encode(value))
+    return num_tokens
+
+
+def route_model(prompt_tokens: int):
+    """Pick the smallest model whose context fits the prompt and the summary."""
+    for model, context_length, max_output in MODELS:
+        if prompt_tokens + min(SUMMARY_TOKENS, max_output) <= context_length:
+            return model, context_length, max_output
+    return None
+
+
+def get_summary(prompt: str, text: str, enc, usage: dict) -> str:
+    """Summarize text, continuing the output if it gets cut off."""
+    messages = build_messages(prompt, text)
+    summary = ""
+    for _ in range(MAX_CONTINUATIONS + 1):
+        prompt_tokens = count_tokens(messages, enc)
+        route = route_model(prompt_tokens)
+        if route is None:
+            raise Exception(
+                f"Prompt of {prompt_tokens} tokens does not fit the context of any model")
+        model, context_length, max_output = route
+        # Cap the output at what the model outputs and what is left of the context window
+        response = create_completion(
+            model, messages, min(context_length - prompt_tokens, max_output))
+        usage['calls'] += 1
+        usage['prompt_tokens'] += response['usage']['prompt_tokens']
+        usage['completion_tokens'] += response['usage']['completion_tokens']
+        usage['models'].append(model)
+        content = response['choices'][0]['message']['content']
+        summary += content
+        if response['choices'][0]['finish_reason'] != 'length':
+            break
+        # Continue the truncated output instead of starting over
+        messages = messages + [{"role": "assistant", "content": content},
+                               {"role": "user", "content": CONTINUE_PROMPT}]
+    else:
+        raise Exception(
+            f"Summary is still truncated after {MAX_CONTINUATIONS} continuations")
+    return summary
 
 
-@retry(stop=stop_after_attempt(2), wait=wait_fixed(60))  # handle rate limiting
-def get_summary(model: str, prompt: str, text: str) -> str:
-    response = openai.ChatCompletion.create(
+@retry(stop=stop_after_attempt(2), wait=wait_fixed(60),
+       retry=retry_if_exception_type(openai.error.RateLimitError))  # handle rate limiting
+def create_completion(model: str, messages: list, max_tokens: int):
+    return openai.ChatCompletion.create(
         model=model,
-        messages=[{"role": "system", "content": prompt}, {
-            "role": "user", "content": text}],
+        messages=messages,
+        max_tokens=max_tokens,
     )
-    if response['choices'][0]['finish_reason'] == 'length':
-        response = openai.ChatCompletion.create(
-            model=model,
-            messages=[{"role": "system", "content": prompt + " Make it short!"}, {
-                "role": "user", "content": text}],
-        )
-    return response['choices'][0]['message']['content']
 
 
 def split_transcript(transcript: str, max_tokens: int, transcript_chunks: list, enc):
@@ -0,0 +1,307 @@
+"""Fakes for Supabase, S3, OpenAI and SMTP with hooks to kill a job at any point."""
+import sys
+import copy
+import types
+import time
+import importlib
+import pytest
+from tenacity import wait_none
+import supabase
+from flask import Flask
+import scribe.config
+
+app = Flask('scribe')
+app.config.from_object(scribe.config)
+app.extensions['supabase'] = None
+with app.app_context():
+    from scribe import summary as summary_module
+
+SUMMARY_ID = 1
+USER_EMAIL = 'user@example.com'
+SCRIBE_EMAIL = 'tryscribeai@gmail.com'
+
+
+class KillJob(BaseException):
+    """Kill the job like a dying process would, bypassing the exception handlers."""
+
+
+class Killer:
+    """Kill the job the nth time it reaches a point."""
+
+    def __init__(self):
+        self.point = None
+        self.count = 0
+
+    def arm(self, point: str, nth: int = 1):
+        self.point = point
+        self.count = nth
+
+    def reached(self, point: str):
+        if point != self.point:
+            return
+        self.count -= 1
+        if self.count == 0:
+            self.point = None
+            raise KillJob(point)
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+
+class FakeQuery:
+    def __init__(self, db):
+        self.db = db
+        self.values = None
+        self.filters = []
+
+    def select(self, *columns):
+        return self
+
+    def update(self, values):
+        self.values = values
+        return self
+
+    def eq(self, column, value):
+        self.filters.append(lambda row: str(row[column]) == str(value))
+        return self
+
+    def is_(self, column, value):
+        assert value == 'null'
+        self.filters.append(lambda row: row.get(column) is None)
+        return self
+
+    def execute(self):
+        rows = [row for row in self.db.rows if all(
+            matches(row) for matches in self.filters)]
+        if self.values is None:
+            return FakeResponse(copy.deepcopy(rows))
+        for row in rows:
+            row.update(copy.deepcopy(self.values))
+        if 'status' in self.values:
+            self.db.statuses.append(self.values['status'])
+        for column in self.values:
+            self.db.killer.reached(f'update:{column}')
+        return FakeResponse(copy.deepcopy(rows))
+
+
+class FakeRpc:
+    def __init__(self, db, name, params):
+        self.db = db
+        self.name = name
+        self.params = params
+
+    def execute(self):
+        params = self.params
+        row = self.db.row(params['summary_id'])
+        if self.name == 'save_checkpoint':
+            row['checkpoints'] = {**row['checkpoints'],
+                                  params['stage']: copy.deepcopy(params['value'])}
+            self.db.killer.reached(f"checkpoint:{params['stage']}")
+            return FakeResponse(None)
+        if self.name == 'claim_job':
+            claim = row['claims'].get(params['job'])
+            expired = time.time() - params['lease_seconds']
+            if claim is not None and claim['worker'] != params['worker'] and claim['claimed_at'] >= expired:
+                return FakeResponse(False)
+            row['claims'] = {**row['claims'], params['job']: {
+                'worker': params['worker'], 'claimed_at': time.time()}}
+            return FakeResponse(True)
+        if self.name == 'release_job':
+            claim = row['claims'].get(params['job'])
+            if claim is not None and claim['worker'] == params['worker']:
+                row['claims'] = {key: value for key,
+                                 value in row['claims'].items() if key != params['job']}
+            return FakeResponse(None)
+        raise ValueError(f'Unknown function {self.name}')
+
+
+class FakeSupabase:
+    """Single summaries table with the functions from schema.sql."""
+
+    def __init__(self, killer):
+        self.killer = killer
+        self.statuses = []
+        self.rows = [{
+            'id': SUMMARY_ID,
+            'user_email': USER_EMAIL,
+            'audio_file': 'audio_uploads/Audio.mp3',
+            'transcript_file': None,
+            'summary_file': None,
+            'status': None,
+            'checkpoints': {},
+            'claims': {},
+            'created_at': '2023-07-01T12:00:00.000000+00:00',
+            'sent_at': None,
+        }]
+
+    def row(self, summary_id):
+        return next(row for row in self.rows if str(row['id']) == str(summary_id))
+
+    def table(self, name):
+        assert name == 'summaries'
+        return FakeQuery(self)
+
+    def rpc(self, name, params):
+        return FakeRpc(self, name, params)
+
+
+class FakeS3:
+    def __init__(self, killer):
+        self.killer = killer
+        self.files = {'audio_uploads/Audio.mp3': b'audio'}
+        self.uploads = []
+        self.downloads = []
+
+    def upload_file(self, Filename, Bucket, Key):
+        with open(Filename, 'rb') as file:
+            self.files[Key] = file.read()
+        self.uploads.append(Key)
+        self.killer.reached(f"upload:{Key.split('/')[0]}")
+
+    def download_file(self, Bucket, Key, Filename):
+        with open(Filename, 'wb') as file:
+            file.write(self.files[Key])
+        self.downloads.append(Key)
+
+
+class FakeOpenAI:
+    """Answer with the queued responses, then with a single word, and record every request."""
+
+    def __init__(self, killer):
+        self.killer = killer
+        self.calls = []
+        self.requests = []
+        self.responses = []
+
+    def create(self, model, messages, max_tokens):
+        self.requests.append(
+            {'model': model, 'messages': messages, 'max_tokens': max_tokens})
+        if self.responses:
+            response = self.responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            content, finish_reason = response
+        else:
+            content, finish_reason = f'summary{len(self.calls) + 1}', 'stop'
+        prompt = messages[0]['content'].split()[0]
+        self.calls.append(prompt)
+        self.killer.reached(f'openai:{prompt}')
+        return {
+            'choices': [{'message': {'content': content}, 'finish_reason': finish_reason}],
+            'usage': {'prompt_tokens': 1, 'completion_tokens': 1},
+        }
+
+
+class FakeSMTP:
+    """Record every email sent."""
+    sent = []
+    killer = None
+
+    def __init__(self, host, port, context=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def login(self, user, password):
+        pass
+
+    def send_message(self, msg):
+        FakeSMTP.sent.append((msg['To'], msg['Subject']))
+        FakeSMTP.killer.reached(f"email:{msg['To']}")
+
+
+class FakeEncoding:
+    """One token per word."""
+
+    def encode(self, text):
+        return text.split()
+
+
+@pytest.fixture
+def killer():
+    return Killer()
+
+
+@pytest.fixture
+def db(killer):
+    return FakeSupabase(killer)
+
+
+@pytest.fixture
+def s3(killer):
+    return FakeS3(killer)
+
+
+@pytest.fixture
+def emails(killer, monkeypatch):
+    monkeypatch.setattr(FakeSMTP, 'sent', [])
+    monkeypatch.setattr(FakeSMTP, 'killer', killer)
+    return FakeSMTP.sent
+
+
+@pytest.fixture
+def openai(killer):
+    return FakeOpenAI(killer)
+
+
+@pytest.fixture
+def summary(db, s3, openai, emails, tmp_path, monkeypatch):
+    """The summary module wired to the fakes, with small context windows."""
+    (tmp_path / 'summaries').mkdir()
+    (tmp_path / 'transcripts').mkdir()
+    monkeypatch.setattr(summary_module, 'supabase', db)
+    monkeypatch.setattr(summary_module, 'SUMMARIES_FOLDER',
+                        tmp_path / 'summaries')
+    monkeypatch.setattr(summary_module, 'TRANSCRIPTS_FOLDER',
+                        tmp_path / 'transcripts')
+    monkeypatch.setattr(summary_module.boto3, 'client', lambda name: s3)
+    monkeypatch.setattr(summary_module.smtplib, 'SMTP_SSL', FakeSMTP)
+    monkeypatch.setattr(summary_module.tiktoken,
+                        'encoding_for_model', lambda model: FakeEncoding())
+    monkeypatch.setattr(summary_module, 'MODELS', [
+                        ('small', 200, 100), ('large', 400, 100)])
+    monkeypatch.setattr(summary_module, 'SUMMARY_TOKENS', 50)
+    monkeypatch.setattr(summary_module, 'RETRY_WAIT', 0)
+    monkeypatch.setattr(summary_module.create_completion.retry,
+                        'wait', wait_none())
+    monkeypatch.setattr(summary_module.openai.ChatCompletion,
+                        'create', openai.create)
+    monkeypatch.setenv('PROMPT_SUMMARY', 'summary')
+    monkeypatch.setenv('PROMPT_CHUNK_SUMMARY', 'chunk')
+    monkeypatch.setenv('PROMPT_FINAL_SUMMARY', 'final')
+    monkeypatch.setenv('GMAIL_PASSWORD', 'password')
+    return summary_module
+
+
+@pytest.fixture
+def transcribe(db, s3, tmp_path, monkeypatch):
+    """A fresh transcribe.py for summary_id 1 wired to the fakes, with the summarize API recorded."""
+    whisper = types.ModuleType('whisper')
+    whisper.load_audio = lambda filename: filename
+    whisper.transcriptions = []
+
+    class Model:
+        def transcribe(self, audio):
+            whisper.transcriptions.append(audio)
+            return {'text': 'hello world'}
+    whisper.load_model = lambda name: Model()
+    monkeypatch.setitem(sys.modules, 'whisper', whisper)
+    monkeypatch.setattr(supabase, 'create_client', lambda url, key: db)
+    monkeypatch.setattr(sys, 'argv', ['transcribe.py', str(SUMMARY_ID)])
+    monkeypatch.delitem(sys.modules, 'transcribe', raising=False)
+    module = importlib.import_module('transcribe')
+    monkeypatch.setattr(module.boto3, 'client', lambda name: s3)
+    module.summarize_requests = []
+
+    def post(url, json, timeout):
+        module.summarize_requests.append(json)
+        return types.SimpleNamespace(status_code=202, text='')
+    monkeypatch.setattr(module.requests, 'post', post)
+    monkeypatch.setattr(module, 'DOWNLOAD_FOLDER', tmp_path)
+    return module
@@ -0,0 +1,201 @@
+"""Kill jobs at every checkpoint and check that retries resume without redoing finished stages."""
+import time
+import pytest
+from openai import error
+from .conftest import KillJob, SUMMARY_ID, USER_EMAIL, SCRIBE_EMAIL
+
+APPROVAL_LINK = 'http://localhost/api/v1/approve/1'
+TRANSCRIPT_FILE = 'transcripts/Transcript.txt'
+# Splits into 4 chunks with the small context windows of the summary fixture
+TRANSCRIPT = ' '.join(f'word{i}' for i in range(1000))
+APPROVAL_EMAIL = (SCRIBE_EMAIL, 'Generated summary for approval')
+
+
+@pytest.fixture
+def transcript_filename(summary, db, s3):
+    """A transcript on S3 and on disk with its summary job recorded, like /summarize/ leaves it."""
+    filename = summary.TRANSCRIPTS_FOLDER / 'Transcript.txt'
+    filename.write_text(TRANSCRIPT, encoding='UTF-8')
+    s3.files[TRANSCRIPT_FILE] = TRANSCRIPT.encode('UTF-8')
+    db.row(SUMMARY_ID)['transcript_file'] = TRANSCRIPT_FILE
+    db.row(SUMMARY_ID)['checkpoints'] = {'approval_link': APPROVAL_LINK}
+    return str(filename)
+
+
+def kill_and_retry(job, killer, point, nth=1):
+    """Kill the job the nth time it reaches point, then run it again."""
+    killer.arm(point, nth)
+    with pytest.raises(KillJob):
+        job()
+    job()
+
+
+def kill_and_resume(job, summary, db, killer, point, nth=1):
+    """Kill the job like a dying process, which leaves its claim behind, then resume it once the claim expires."""
+    killer.arm(point, nth)
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(summary, 'release_job', lambda *args: None)
+        with pytest.raises(KillJob):
+            job()
+    claims = db.row(SUMMARY_ID)['claims']
+    assert len(claims) == 1
+
+    # The claim of the dead worker refuses an immediate retry
+    checkpoints = dict(db.row(SUMMARY_ID)['checkpoints'])
+    job()
+    assert summary.resume_jobs() == []
+    assert db.row(SUMMARY_ID)['claims'] == claims
+    assert db.row(SUMMARY_ID)['checkpoints'] == checkpoints
+
+    for claim in claims.values():
+        claim['claimed_at'] -= summary.CLAIM_LEASE + 1
+    threads = summary.resume_jobs()
+    assert len(threads) == 1
+    threads[0].join()
+    assert db.row(SUMMARY_ID)['claims'] == {}
+
+
+def test_transcribe_resumes_after_transcript_upload(transcribe, killer, s3):
+    kill_and_retry(transcribe.main, killer, 'update:transcript_file')
+    assert len(transcribe.whisper.transcriptions) == 1
+    assert len([key for key in s3.uploads if key.startswith('transcripts/')]) == 1
+    assert len(transcribe.summarize_requests) == 1
+
+
+def test_transcribe_resumes_after_summary_request(transcribe, killer, db):
+    kill_and_retry(transcribe.main, killer, 'checkpoint:summary_requested')
+    assert len(transcribe.whisper.transcriptions) == 1
+    assert len(transcribe.summarize_requests) == 1
+    assert db.row(SUMMARY_ID)['checkpoints'] == {'summary_requested': True}
+
+
+def test_transcribe_error_is_final_on_last_attempt(transcribe, db, s3, monkeypatch):
+    monkeypatch.setattr(transcribe, 'BATCH_ATTEMPTS', 2)
+    del s3.files['audio_uploads/Audio.mp3']
+    with pytest.raises(SystemExit):
+        transcribe.main()
+    assert db.row(SUMMARY_ID)['status'].startswith('Retrying: ')
+
+    monkeypatch.setattr(transcribe, 'BATCH_ATTEMPT', 2)
+    with pytest.raises(SystemExit):
+        transcribe.main()
+    assert db.row(SUMMARY_ID)['status'].startswith('Error: ')
+
+    s3.files['audio_uploads/Audio.mp3'] = b'audio'
+    transcribe.main()
+    assert db.row(SUMMARY_ID)['status'] is None
+
+
+@pytest.mark.parametrize('nth', [1, 2, 3, 4])
+def test_summary_resumes_after_chunk(summary, killer, openai, emails, db, transcript_filename, nth):
+    kill_and_resume(lambda: summary.generate_summary(
+        SUMMARY_ID, transcript_filename, APPROVAL_LINK), summary, db, killer, 'checkpoint:chunk_summaries', nth)
+    assert openai.calls == ['chunk'] * 4 + ['final']
+    assert emails == [APPROVAL_EMAIL]
+
+
+def test_summary_resumes_after_summary_upload(summary, killer, openai, emails, s3, db, transcript_filename):
+    kill_and_resume(lambda: summary.generate_summary(
+        SUMMARY_ID, transcript_filename, APPROVAL_LINK), summary, db, killer, 'update:summary_file')
+    assert openai.calls == ['chunk'] * 4 + ['final']
+    assert len([key for key in s3.uploads if key.startswith('summaries/')]) == 1
+    assert db.row(SUMMARY_ID)['summary_file'] in s3.downloads
+    assert emails == [APPROVAL_EMAIL]
+
+
+def test_summary_resumes_after_approval_email(summary, killer, openai, emails, db, transcript_filename):
+    kill_and_retry(lambda: summary.generate_summary(
+        SUMMARY_ID, transcript_filename, APPROVAL_LINK), killer, 'checkpoint:approval_email_sent')
+    assert openai.calls == ['chunk'] * 4 + ['final']
+    assert emails == [APPROVAL_EMAIL]
+    # Nothing is left to resume until the summary is approved
+    assert summary.resume_jobs() == []
+
+
+def test_send_summary_resumes_after_summary_email(summary, killer, emails, db, s3, tmp_path):
+    summary_filename = tmp_path / 'Summary.txt'
+    transcript_filename = tmp_path / 'Transcript.txt'
+    s3.files['summaries/Summary.txt'] = b'summary'
+    s3.files[TRANSCRIPT_FILE] = b'transcript'
+    db.row(SUMMARY_ID).update({'summary_file': 'summaries/Summary.txt', 'transcript_file': TRANSCRIPT_FILE,
+                               'checkpoints': {'approval_link': APPROVAL_LINK, 'approval_email_sent': True,
+                                               'summary_approved': True}})
+
+    def send():
+        summary_filename.write_text('summary', encoding='UTF-8')
+        transcript_filename.write_text('transcript', encoding='UTF-8')
+        summary.send_summary(SUMMARY_ID, USER_EMAIL, str(
+            summary_filename), str(transcript_filename))
+
+    kill_and_resume(send, summary, db, killer, 'checkpoint:summary_email_sent')
+    assert emails == [(USER_EMAIL, 'Scribe Summary')]
+    assert db.row(SUMMARY_ID)['status'] == 'Success'
+    assert summary.resume_jobs() == []
+
+
+def test_summary_retries_transient_error(summary, openai, emails, db, transcript_filename):
+    openai.responses = [error.ServiceUnavailableError('Overloaded')]
+    summary.generate_summary(SUMMARY_ID, transcript_filename, APPROVAL_LINK)
+    assert openai.calls == ['chunk'] * 4 + ['final']
+    assert emails == [APPROVAL_EMAIL]
+    assert db.row(SUMMARY_ID)['status'] is None
+    assert db.row(SUMMARY_ID)['claims'] == {}
+
+
+def test_summary_error_is_final_on_last_attempt(summary, openai, emails, db, transcript_filename):
+    openai.responses = [error.ServiceUnavailableError(
+        'Overloaded')] * summary.MAX_ATTEMPTS
+    summary.generate_summary(SUMMARY_ID, transcript_filename, APPROVAL_LINK)
+    assert emails == []
+    assert db.row(SUMMARY_ID)['status'].startswith('Error: ')
+    assert db.row(SUMMARY_ID)['claims'] == {}
+    # A final error is not resumed
+    assert summary.resume_jobs() == []
+
+
+@pytest.mark.parametrize('fail', [
+    lambda monkeypatch, openai: monkeypatch.delenv('PROMPT_SUMMARY'),
+    lambda monkeypatch, openai: monkeypatch.delenv('GMAIL_PASSWORD'),
+    lambda monkeypatch, openai: setattr(openai, 'responses', [
+                                        error.InvalidRequestError('Too long', None)]),
+    lambda monkeypatch, openai: setattr(openai, 'responses', [
+                                        ('part ', 'length')] * 3),
+], ids=['prompts not set', 'no email password', 'invalid request', 'still truncated'])
+def test_summary_does_not_retry_permanent_error(summary, openai, emails, db, transcript_filename, monkeypatch, fail):
+    fail(monkeypatch, openai)
+    summary.generate_summary(SUMMARY_ID, transcript_filename, APPROVAL_LINK)
+    assert emails == []
+    assert len(db.statuses) == 1
+    assert db.statuses[0].startswith('Error: ')
+
+
+def test_summary_skips_job_claimed_by_another_worker(summary, openai, emails, db, transcript_filename):
+    db.row(SUMMARY_ID)['claims'] = {'generate_summary': {
+        'worker': 'other', 'claimed_at': time.time()}}
+    summary.generate_summary(SUMMARY_ID, transcript_filename, APPROVAL_LINK)
+    assert openai.calls == []
+    assert emails == []
+
+
+def test_resume_jobs_restarts_job_that_never_started(summary, openai, emails, db, transcript_filename):
+    threads = summary.resume_jobs()
+    assert len(threads) == 1
+    threads[0].join()
+    assert openai.calls == ['chunk'] * 4 + ['final']
+    assert emails == [APPROVAL_EMAIL]
+
+
+def test_summary_discards_chunks_split_differently(summary, killer, openai, db, transcript_filename, monkeypatch):
+    killer.arm('checkpoint:chunk_summaries', 2)
+    with pytest.raises(KillJob):
+        summary.generate_summary(
+            SUMMARY_ID, transcript_filename, APPROVAL_LINK)
+    chunks_hash = db.row(SUMMARY_ID)['checkpoints']['chunk_summaries']['chunks_hash']
+
+    # A longer prompt leaves less room for each chunk, so the transcript splits into 8 chunks
+    monkeypatch.setenv('PROMPT_CHUNK_SUMMARY', ' '.join(['chunk'] * 100))
+    summary.generate_summary(SUMMARY_ID, transcript_filename, APPROVAL_LINK)
+    chunk_summaries = db.row(SUMMARY_ID)['checkpoints']['chunk_summaries']
+    assert chunk_summaries['chunks_hash'] != chunks_hash
+    assert len(chunk_summaries['summaries']) == 8
+    assert len(openai.calls) == 2 + 8 + 1
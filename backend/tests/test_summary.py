@@ -0,0 +1,88 @@
+"""Token counting, model routing and continuation of truncated summaries."""
+import pytest
+from openai import error
+from .conftest import FakeEncoding
+
+
+def words(count: int) -> str:
+    return ' '.join(f'word{i}' for i in range(count))
+
+
+def new_usage() -> dict:
+    return {'calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'models': []}
+
+
+def test_count_tokens_counts_every_value_and_overhead(summary):
+    messages = summary.build_messages('be brief', 'hello there world')
+    # system (1) + 'be brief' (2) + user (1) + 'hello there world' (3)
+    assert summary.count_tokens(messages, FakeEncoding()) == \
+        summary.REPLY_TOKENS + summary.SAFETY_TOKENS + 2 * summary.MESSAGE_TOKENS + 7
+
+
+def test_route_model_picks_smallest_model_that_fits(summary):
+    assert summary.route_model(150) == ('small', 200, 100)
+    assert summary.route_model(151) == ('large', 400, 100)
+    assert summary.route_model(350) == ('large', 400, 100)
+    assert summary.route_model(351) is None
+
+
+def test_route_model_budgets_at_most_the_model_output(summary, monkeypatch):
+    monkeypatch.setattr(summary, 'MODELS', [('small', 200, 20)])
+    assert summary.route_model(180) == ('small', 200, 20)
+    assert summary.route_model(181) is None
+
+
+def test_get_summary_caps_max_tokens(summary, openai):
+    summary.get_summary('summary', words(10), FakeEncoding(), new_usage())
+    prompt_tokens = summary.count_tokens(
+        summary.build_messages('summary', words(10)), FakeEncoding())
+    assert openai.requests[0]['model'] == 'small'
+    assert openai.requests[0]['max_tokens'] == min(200 - prompt_tokens, 100)
+
+
+def test_get_summary_continues_truncated_output(summary, openai):
+    openai.responses = [('first half ', 'length'), ('second half', 'stop')]
+    usage = new_usage()
+    assert summary.get_summary('summary', words(10), FakeEncoding(),
+                               usage) == 'first half second half'
+    assert openai.requests[1]['messages'][2:] == [
+        {'role': 'assistant', 'content': 'first half '},
+        {'role': 'user', 'content': summary.CONTINUE_PROMPT},
+    ]
+    assert usage['calls'] == 2
+    assert usage['models'] == ['small', 'small']
+
+
+def test_get_summary_raises_when_still_truncated(summary, openai):
+    openai.responses = [('part ', 'length')] * \
+        (summary.MAX_CONTINUATIONS + 1)
+    with pytest.raises(Exception, match='still truncated'):
+        summary.get_summary('summary', words(10), FakeEncoding(), new_usage())
+    assert len(openai.requests) == summary.MAX_CONTINUATIONS + 1
+
+
+def test_get_summary_raises_when_prompt_does_not_fit(summary, openai):
+    with pytest.raises(Exception, match='does not fit'):
+        summary.get_summary('summary', words(400), FakeEncoding(), new_usage())
+    assert openai.requests == []
+
+
+def test_get_summary_raises_when_continuation_does_not_fit(summary, openai):
+    openai.responses = [(words(30), 'length')]
+    with pytest.raises(Exception, match='does not fit'):
+        summary.get_summary('summary', words(280), FakeEncoding(), new_usage())
+    assert len(openai.requests) == 1
+
+
+def test_create_completion_retries_rate_limits(summary, openai):
+    openai.responses = [error.RateLimitError('Slow down'), ('done', 'stop')]
+    assert summary.get_summary(
+        'summary', words(10), FakeEncoding(), new_usage()) == 'done'
+    assert len(openai.requests) == 2
+
+
+def test_create_completion_does_not_retry_invalid_requests(summary, openai):
+    openai.responses = [error.InvalidRequestError('Too long', None)]
+    with pytest.raises(error.InvalidRequestError):
+        summary.get_summary('summary', words(10), FakeEncoding(), new_usage())
+    assert len(openai.requests) == 1
@@ -1,5 +1,6 @@
 """Celery tasks."""
 import os
+import sys
 import time
 import argparse
 import pathlib
@@ -15,6 +16,9 @@ import boto3
 load_dotenv()
 DOWNLOAD_FOLDER = pathlib.Path(__file__).resolve().parent
 S3_BUCKET = "scribe-backend-files"
+# Batch sets the attempt number, the number of attempts comes from retryStrategy in api.py
+BATCH_ATTEMPT = int(os.getenv("AWS_BATCH_JOB_ATTEMPT", "1"))
+BATCH_ATTEMPTS = int(os.getenv("BATCH_ATTEMPTS", "1"))
 supabase: Client = create_client(
     os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY"))
 
@@ -33,11 +37,22 @@ def handle_exceptions(func):
         except Exception:
             trace = traceback.format_exc()
             print(trace, flush=True)
+            # Only the last attempt's error is final
+            status = 'Error' if BATCH_ATTEMPT >= BATCH_ATTEMPTS else 'Retrying'
             supabase.table('summaries').update(
-                {'status': f'Error: {trace}'}).eq('id', summary_id).execute()
+                {'status': f'{status}: {trace}'}).eq('id', summary_id).execute()
+            # Exit with an error so that Batch retries the job from the last checkpoint
+            sys.exit(1)
     return decorated
 
 
+def save_checkpoint(checkpoints: dict, stage: str, value=True):
+    """Merge a completed stage of the job into the database."""
+    checkpoints[stage] = value
+    supabase.rpc('save_checkpoint', {'summary_id': summary_id,
+                 'stage': stage, 'value': value}).execute()
+
+
 def generate_transcript(audio_filename, user_email):
     start_time = time.time()
 
@@ -84,32 +99,48 @@ def main():
 
     print(f"Generating transcript for summary_id: {summary_id}")
 
+    # Clear the error of the previous attempt
+    if BATCH_ATTEMPT > 1:
+        supabase.table('summaries').update(
+            {'status': None}).eq('id', summary_id).execute()
+
     # Fetch summary_id entry from supabase
     res = supabase.table("summaries").select(
         "*").eq('id', summary_id).execute().data[0]
 
-    # Check if transcript file already exists
-    if res['transcript_file'] is not None:
-        return
-    audio_file = res['audio_file']
+    checkpoints = res['checkpoints'] or {}
+
+    # Skip the transcription if a previous attempt already uploaded the transcript
+    s3_filename = res['transcript_file']
+    if s3_filename is None:
+        audio_file = res['audio_file']
 
-    # Download audio file from S3
-    s3 = boto3.client('s3')
-    download_path = f'{DOWNLOAD_FOLDER}/{audio_file.split("/")[-1]}'
-    s3.download_file(Bucket=S3_BUCKET,
-                     Key=audio_file, Filename=download_path)
+        # Download audio file from S3
+        s3 = boto3.client('s3')
+        download_path = f'{DOWNLOAD_FOLDER}/{audio_file.split("/")[-1]}'
+        s3.download_file(Bucket=S3_BUCKET,
+                         Key=audio_file, Filename=download_path)
 
-    # Generate transcript
-    transcript_filename = generate_transcript(download_path, res['user_email'])
+        # Generate transcript
+        transcript_filename = generate_transcript(
+            download_path, res['user_email'])
 
-    # Upload transcript to S3
-    s3_filename = f'transcripts/{transcript_filename.split("/")[-1]}'
-    s3.upload_file(Filename=transcript_filename,
-                   Bucket=S3_BUCKET, Key=s3_filename)
+        # Upload transcript to S3
+        s3_filename = f'transcripts/{transcript_filename.split("/")[-1]}'
+        s3.upload_file(Filename=transcript_filename,
+                       Bucket=S3_BUCKET, Key=s3_filename)
 
-    # add transcript file to supabase
-    supabase.table('summaries').update(
-        {'transcript_file': s3_filename}).eq('id', res['id']).execute()
+        # add transcript file to supabase
+        supabase.table('summaries').update(
+            {'transcript_file': s3_filename}).eq('id', res['id']).execute()
+
+        # delete audio and transcript file
+        os.remove(download_path)
+        os.remove(transcript_filename)
+
+    # Check if the summary was already requested
+    if checkpoints.get('summary_requested'):
+        return
 
     # send api request to summarize the transcript
     url = os.getenv("SUMMARIZE_URL")
@@ -117,10 +148,7 @@ def main():
         url, json={'transcript_file': s3_filename, 'id': res['id']}, timeout=10)
     if response.status_code != 202:
         raise Exception(f"Error sending request: {response.text}")
-
-    # delete audio and transcript file
-    os.remove(download_path)
-    os.remove(transcript_filename)
+    save_checkpoint(checkpoints, 'summary_requested')
 
 
 if __name__ == '__main__':